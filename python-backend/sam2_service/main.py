@@ -8,6 +8,7 @@ import os
 import io
 import base64
 import logging
+import threading
 from typing import List, Dict, Any, Optional, Tuple
 import asyncio
 from concurrent.futures import ThreadPoolExecutor
@@ -16,12 +17,19 @@ import numpy as np
 import cv2
 from PIL import Image
 import torch
+import httpx
+import orjson
 from fastapi import FastAPI, File, UploadFile, Form, HTTPException
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import JSONResponse
+from fastapi.responses import ORJSONResponse
 import uvicorn
 
-from sam2_predictor import SAM2Predictor
+from sam2_predictor import (
+    SAM2Predictor,
+    DEFAULT_POINTS_PER_SIDE,
+    DEFAULT_POINTS_PER_BATCH,
+    DEFAULT_CROP_N_LAYERS,
+)
 
 # Configure logging
 logging.basicConfig(level=logging.INFO)
@@ -31,7 +39,8 @@ logger = logging.getLogger(__name__)
 app = FastAPI(
     title="SAM 2 Segmentation Service",
     description="Image segmentation service using Segment Anything 2",
-    version="1.0.0"
+    version="1.0.0",
+    default_response_class=ORJSONResponse
 )
 
 # Add CORS middleware
@@ -45,16 +54,37 @@ app.add_middleware(
 
 # Global predictor instance
 predictor: Optional[SAM2Predictor] = None
-executor = ThreadPoolExecutor(max_workers=2)
+
+# Single GPU worker: all model calls run here, one at a time, so requests queue
+# on the executor (not on locks inside pool threads) and never share the model concurrently
+executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="sam2-gpu")
+
+# Separate pool for mask encoding (PIL/zlib release the GIL, so this scales with cores)
+ENCODE_WORKERS = int(os.getenv("SAM2_ENCODE_WORKERS", os.cpu_count() or 1))
+encode_executor = ThreadPoolExecutor(max_workers=ENCODE_WORKERS)
+
+# Micro-batching of concurrent prompt requests
+MAX_BATCH = int(os.getenv("SAM2_MAX_BATCH", 8))
+MAX_WAIT = float(os.getenv("SAM2_BATCH_WAIT_MS", 10)) / 1000
 
 @app.on_event("startup")
 async def startup_event():
     """Initialize SAM 2 model on startup"""
     global predictor
+    
+    # Shared HTTP client for image downloads (connection pooling + HTTP/2)
+    app.state.http = httpx.AsyncClient(
+        http2=True,
+        follow_redirects=True,
+        timeout=30,
+        limits=httpx.Limits(max_connections=64)
+    )
+    
     try:
         logger.info("Loading SAM 2 model...")
         predictor = SAM2Predictor()
         await predictor.load_model()
+        scheduler.start()
         logger.info("SAM 2 model loaded successfully!")
     except Exception as e:
         logger.error(f"Failed to load SAM 2 model: {e}")
@@ -64,14 +94,24 @@ async def startup_event():
 async def shutdown_event():
     """Cleanup on shutdown"""
     global predictor
+    await scheduler.stop()
+    await app.state.http.aclose()
     if predictor:
         predictor.cleanup()
     executor.shutdown(wait=True)
+    encode_executor.shutdown(wait=True)
 
 def process_image_data(image_data: bytes) -> np.ndarray:
     """Convert image bytes to numpy array"""
     try:
-        # Convert bytes to PIL Image
+        # Decode with OpenCV (libjpeg-turbo/libpng); ignore EXIF orientation to match PIL
+        buffer = np.frombuffer(image_data, dtype=np.uint8)
+        image_bgr = cv2.imdecode(buffer, cv2.IMREAD_COLOR | cv2.IMREAD_IGNORE_ORIENTATION)
+        
+        if image_bgr is not None:
+            return cv2.cvtColor(image_bgr, cv2.COLOR_BGR2RGB)
+        
+        # Fall back to PIL for formats OpenCV cannot decode (e.g. GIF)
         image = Image.open(io.BytesIO(image_data))
         
         # Convert to RGB if necessary
@@ -86,37 +126,152 @@ def process_image_data(image_data: bytes) -> np.ndarray:
         logger.error(f"Error processing image data: {e}")
         raise HTTPException(status_code=400, detail="Invalid image data")
 
+# Per-thread PNG output buffer, reused across masks on the encode pool
+_encode_local = threading.local()
+
+def _get_encode_buffer() -> io.BytesIO:
+    """
+    Return this thread's reusable BytesIO, rewound to the start. It is not
+    truncated (that would release its storage), so callers must only read
+    up to buffer.tell() after writing
+    """
+    buffer = getattr(_encode_local, 'buffer', None)
+    if buffer is None:
+        buffer = _encode_local.buffer = io.BytesIO()
+    buffer.seek(0)
+    return buffer
+
 def encode_mask_to_base64(mask: np.ndarray) -> str:
     """Encode mask array to base64 string"""
     try:
-        # Convert boolean mask to uint8
-        mask_uint8 = (mask * 255).astype(np.uint8)
+        # Convert mask to uint8 in a single pass (no float64 temporary)
+        mask_uint8 = np.multiply(mask, np.uint8(255), dtype=np.uint8, casting='unsafe')
         
-        # Convert to PIL Image
-        mask_image = Image.fromarray(mask_uint8, mode='L')
+        # Convert to a 1-bit PIL Image (masks are binary, so no information is lost)
+        mask_image = Image.fromarray(mask_uint8, mode='L').convert('1', dither=Image.NONE)
         
-        # Convert to base64
-        buffer = io.BytesIO()
-        mask_image.save(buffer, format='PNG')
-        mask_base64 = base64.b64encode(buffer.getvalue()).decode('utf-8')
+        # Convert to base64 (PNG is lossless at every level, so favour speed over size)
+        buffer = _get_encode_buffer()
+        mask_image.save(buffer, format='PNG', compress_level=1)
+        png_size = buffer.tell()
+        with buffer.getbuffer() as view, view[:png_size] as png_bytes:
+            mask_base64 = base64.b64encode(png_bytes).decode('ascii')
         
         return mask_base64
     except Exception as e:
         logger.error(f"Error encoding mask: {e}")
         return ""
 
+def encode_mask_packed(mask: np.ndarray) -> Dict[str, Any]:
+    """Encode mask as base64 of its row-major bits (np.packbits, MSB first)"""
+    mask = np.asarray(mask, dtype=np.bool_)
+    packed = np.packbits(mask.reshape(-1))
+    return {
+        'shape': list(mask.shape),
+        'data': base64.b64encode(packed).decode('ascii')
+    }
+
+def encode_mask_rle(mask: np.ndarray) -> Dict[str, Any]:
+    """Encode mask as COCO run-length encoding {size, counts}"""
+    from pycocotools import mask as mask_util
+    
+    rle = mask_util.encode(np.asfortranarray(np.asarray(mask, dtype=np.uint8)))
+    return {
+        'size': [int(v) for v in rle['size']],
+        'counts': rle['counts'].decode('ascii')
+    }
+
+# Supported mask encodings for the `mask_format` form field
+MASK_ENCODERS = {
+    'png': encode_mask_to_base64,
+    'packed_bits': encode_mask_packed,
+    'rle': encode_mask_rle,
+}
+
+def compute_mask_areas(masks: List[Any]) -> List[int]:
+    """Compute pixel area of every mask in a single vectorized reduction"""
+    if len(masks) == 0:
+        return []
+    
+    # Already a (N, H, W) array for prompt modes; a list of (H, W) arrays otherwise
+    masks_arr = np.asarray(masks, dtype=np.bool_)
+    return masks_arr.reshape(len(masks), -1).sum(axis=1, dtype=np.int64).tolist()
+
+def _build_response(
+    masks: List[Any],
+    scores: List[float],
+    mask_format: str = 'png'
+) -> List[Dict[str, Any]]:
+    """Build the per-mask response entries (blocking; run off the event loop)"""
+    
+    # Compute areas and scores for all masks at once
+    areas = compute_mask_areas(masks)
+    scores = np.asarray(scores, dtype=float).tolist()
+    
+    # Encode masks in parallel
+    encoder = MASK_ENCODERS[mask_format]
+    encoded_list = list(encode_executor.map(encoder, masks))
+    
+    encoded_masks = []
+    for i, encoded_mask in enumerate(encoded_list):
+        encoded_masks.append({
+            'id': i,
+            'mask': encoded_mask,
+            'score': scores[i] if i < len(scores) else 0.0,
+            'area': areas[i]
+        })
+    
+    return encoded_masks
+
+# Upper bounds for request-supplied 'everything' settings, to cap GPU/host memory use
+MAX_POINTS_PER_SIDE = 64
+MAX_POINTS_PER_BATCH = 256
+MAX_CROP_N_LAYERS = 2
+
+def parse_everything_options(
+    points_per_side: int,
+    points_per_batch: int,
+    crop_n_layers: int
+) -> Dict[str, int]:
+    """Validate automatic mask generator settings from the request"""
+    if not (
+        1 <= points_per_side <= MAX_POINTS_PER_SIDE
+        and 1 <= points_per_batch <= MAX_POINTS_PER_BATCH
+        and 0 <= crop_n_layers <= MAX_CROP_N_LAYERS
+    ):
+        raise HTTPException(
+            status_code=400,
+            detail=(
+                f"points_per_side must be 1-{MAX_POINTS_PER_SIDE}, "
+                f"points_per_batch 1-{MAX_POINTS_PER_BATCH}, "
+                f"crop_n_layers 0-{MAX_CROP_N_LAYERS}"
+            )
+        )
+    
+    return {
+        'points_per_side': points_per_side,
+        'points_per_batch': points_per_batch,
+        'crop_n_layers': crop_n_layers
+    }
+
+async def run_blocking(func, *args):
+    """Run a blocking CPU-bound function in the default thread pool"""
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(None, func, *args)
+
 async def run_segmentation(
     image_array: np.ndarray,
     mode: str,
     points: Optional[List[List[int]]] = None,
-    boxes: Optional[List[List[int]]] = None
+    boxes: Optional[List[List[int]]] = None,
+    options: Optional[Dict[str, int]] = None
 ) -> Dict[str, Any]:
     """Run SAM 2 segmentation in thread pool"""
     
     def _segment():
         try:
             if mode == "everything":
-                return predictor.segment_everything(image_array)
+                return predictor.segment_everything(image_array, **(options or {}))
             elif mode == "points" and points:
                 return predictor.segment_with_points(image_array, points)
             elif mode == "boxes" and boxes:
@@ -130,6 +285,118 @@ async def run_segmentation(
     loop = asyncio.get_event_loop()
     return await loop.run_in_executor(executor, _segment)
 
+class BatchScheduler:
+    """Coalesces concurrent point/box requests into batched SAM 2 calls"""
+    
+    def __init__(self, max_batch: int = MAX_BATCH, max_wait: float = MAX_WAIT):
+        self.max_batch = max_batch
+        self.max_wait = max_wait
+        self.queue: Optional[asyncio.Queue] = None
+        self._worker: Optional[asyncio.Task] = None
+    
+    def start(self):
+        """Start the batching worker on the running event loop"""
+        self.queue = asyncio.Queue()
+        self._worker = asyncio.create_task(self._run())
+    
+    async def stop(self):
+        """Stop the batching worker"""
+        if self._worker:
+            self._worker.cancel()
+            try:
+                await self._worker
+            except asyncio.CancelledError:
+                pass
+            self._worker = None
+    
+    async def submit(
+        self,
+        image_array: np.ndarray,
+        mode: str,
+        points: Optional[List[List[int]]] = None,
+        boxes: Optional[List[List[int]]] = None,
+        options: Optional[Dict[str, int]] = None
+    ) -> Dict[str, Any]:
+        """Queue a segmentation request and wait for its result"""
+        
+        # Only prompt-based modes can share a forward pass
+        if self.queue is None or not ((mode == "points" and points) or (mode == "boxes" and boxes)):
+            return await run_segmentation(image_array, mode, points, boxes, options)
+        
+        future = asyncio.get_running_loop().create_future()
+        prompts = points if mode == "points" else boxes
+        await self.queue.put((future, image_array, mode, prompts))
+        return await future
+    
+    async def _run(self):
+        """Collect requests for up to max_wait seconds and dispatch them per mode"""
+        loop = asyncio.get_running_loop()
+        
+        while True:
+            batch = [await self.queue.get()]
+            deadline = loop.time() + self.max_wait
+            
+            while len(batch) < self.max_batch:
+                timeout = deadline - loop.time()
+                if timeout <= 0:
+                    break
+                try:
+                    batch.append(await asyncio.wait_for(self.queue.get(), timeout))
+                except asyncio.TimeoutError:
+                    break
+            
+            # Points and boxes use different multimask settings, so batch them separately
+            for mode in ("points", "boxes"):
+                group = [item for item in batch if item[2] == mode and not item[0].done()]
+                if group:
+                    await self._dispatch(mode, group)
+    
+    async def _dispatch(self, mode: str, group: List[Tuple]):
+        """Run one group of same-mode requests and resolve their futures"""
+        if len(group) == 1:
+            # A lone request keeps the single-image path (and its embedding cache)
+            await self._run_single(mode, group[0])
+            return
+        
+        try:
+            images = [item[1] for item in group]
+            prompts = [item[3] for item in group]
+            loop = asyncio.get_running_loop()
+            results = await loop.run_in_executor(
+                executor, predictor.segment_batch, images, mode, prompts
+            )
+        except Exception as e:
+            # Rerun each request alone so a bad request only fails itself
+            logger.warning(f"Batched segmentation failed, retrying individually: {e}")
+            for item in group:
+                await self._run_single(mode, item)
+            return
+        
+        for (future, *_), result in zip(group, results):
+            if not future.done():
+                future.set_result(result)
+    
+    async def _run_single(self, mode: str, item: Tuple):
+        """Run one queued request on the single-image path and resolve its future"""
+        future, image_array, _, prompts = item
+        if future.done():
+            return
+        
+        try:
+            if mode == "points":
+                result = await run_segmentation(image_array, mode, points=prompts)
+            else:
+                result = await run_segmentation(image_array, mode, boxes=prompts)
+        except Exception as e:
+            if not future.done():
+                future.set_exception(e)
+            return
+        
+        if not future.done():
+            future.set_result(result)
+
+scheduler = BatchScheduler()
+
 @app.get("/health")
 async def health_check():
     """Health check endpoint"""
@@ -144,7 +411,11 @@ async def segment_image(
     file: UploadFile = File(...),
     mode: str = Form("everything"),
     points: Optional[str] = Form(None),
-    boxes: Optional[str] = Form(None)
+    boxes: Optional[str] = Form(None),
+    mask_format: str = Form('png'),
+    points_per_side: int = Form(DEFAULT_POINTS_PER_SIDE),
+    points_per_batch: int = Form(DEFAULT_POINTS_PER_BATCH),
+    crop_n_layers: int = Form(DEFAULT_CROP_N_LAYERS)
 ):
     """
     Segment image using SAM 2
@@ -154,6 +425,12 @@ async def segment_image(
         mode: Segmentation mode ('everything', 'points', 'boxes')
         points: JSON string of point coordinates [[x1,y1], [x2,y2], ...]
         boxes: JSON string of box coordinates [[x1,y1,x2,y2], ...]
+        mask_format: Mask encoding ('png' base64 image, 'packed_bits'
+            {shape, data} where data is base64 of np.packbits of the mask,
+            or 'rle' COCO run-length encoding {size, counts})
+        points_per_side: 'everything' mode point grid size (prompts = side^2)
+        points_per_batch: 'everything' mode prompts per decoder batch
+        crop_n_layers: 'everything' mode extra crop layers (0 for interactive use)
     
     Returns:
         JSON response with segmentation masks and metadata
@@ -162,44 +439,39 @@ async def segment_image(
     if not predictor:
         raise HTTPException(status_code=503, detail="SAM 2 model not loaded")
     
+    if mask_format not in MASK_ENCODERS:
+        raise HTTPException(status_code=400, detail=f"Invalid mask format: {mask_format}")
+    
+    options = parse_everything_options(points_per_side, points_per_batch, crop_n_layers)
+    
     try:
         # Read and process image
         image_data = await file.read()
-        image_array = process_image_data(image_data)
+        image_array = await run_blocking(process_image_data, image_data)
         
         # Parse points and boxes if provided
         parsed_points = None
         parsed_boxes = None
         
         if points:
-            import json
-            parsed_points = json.loads(points)
+            parsed_points = orjson.loads(points)
         
         if boxes:
-            import json
-            parsed_boxes = json.loads(boxes)
+            parsed_boxes = orjson.loads(boxes)
         
         # Run segmentation
-        result = await run_segmentation(
-            image_array, mode, parsed_points, parsed_boxes
+        result = await scheduler.submit(
+            image_array, mode, parsed_points, parsed_boxes, options
         )
         
         # Process results
         masks = result.get('masks', [])
         scores = result.get('scores', [])
         
-        # Encode masks to base64
-        encoded_masks = []
-        for i, mask in enumerate(masks):
-            mask_base64 = encode_mask_to_base64(mask)
-            encoded_masks.append({
-                'id': i,
-                'mask': mask_base64,
-                'score': float(scores[i]) if i < len(scores) else 0.0,
-                'area': int(np.sum(mask))
-            })
-        
-        return JSONResponse({
+        # Encode masks off the event loop
+        encoded_masks = await run_blocking(_build_response, masks, scores, mask_format)
+        
+        return ORJSONResponse({
             'success': True,
             'mode': mode,
             'num_masks': len(encoded_masks),
@@ -216,7 +488,11 @@ async def segment_image_url(
     image_url: str = Form(...),
     mode: str = Form("everything"),
     points: Optional[str] = Form(None),
-    boxes: Optional[str] = Form(None)
+    boxes: Optional[str] = Form(None),
+    mask_format: str = Form('png'),
+    points_per_side: int = Form(DEFAULT_POINTS_PER_SIDE),
+    points_per_batch: int = Form(DEFAULT_POINTS_PER_BATCH),
+    crop_n_layers: int = Form(DEFAULT_CROP_N_LAYERS)
 ):
     """
     Segment image from URL using SAM 2
@@ -225,49 +501,42 @@ async def segment_image_url(
     if not predictor:
         raise HTTPException(status_code=503, detail="SAM 2 model not loaded")
     
+    if mask_format not in MASK_ENCODERS:
+        raise HTTPException(status_code=400, detail=f"Invalid mask format: {mask_format}")
+    
+    options = parse_everything_options(points_per_side, points_per_batch, crop_n_layers)
+    
     try:
-        import requests
-        
         # Download image from URL
-        response = requests.get(image_url, timeout=30)
+        response = await app.state.http.get(image_url)
         response.raise_for_status()
         
         # Process image
-        image_array = process_image_data(response.content)
+        image_array = await run_blocking(process_image_data, response.content)
         
         # Parse points and boxes if provided
         parsed_points = None
         parsed_boxes = None
         
         if points:
-            import json
-            parsed_points = json.loads(points)
+            parsed_points = orjson.loads(points)
         
         if boxes:
-            import json
-            parsed_boxes = json.loads(boxes)
+            parsed_boxes = orjson.loads(boxes)
         
         # Run segmentation
-        result = await run_segmentation(
-            image_array, mode, parsed_points, parsed_boxes
+        result = await scheduler.submit(
+            image_array, mode, parsed_points, parsed_boxes, options
         )
         
         # Process results
         masks = result.get('masks', [])
         scores = result.get('scores', [])
         
-        # Encode masks to base64
-        encoded_masks = []
-        for i, mask in enumerate(masks):
-            mask_base64 = encode_mask_to_base64(mask)
-            encoded_masks.append({
-                'id': i,
-                'mask': mask_base64,
-                'score': float(scores[i]) if i < len(scores) else 0.0,
-                'area': int(np.sum(mask))
-            })
-        
-        return JSONResponse({
+        # Encode masks off the event loop
+        encoded_masks = await run_blocking(_build_response, masks, scores, mask_format)
+        
+        return ORJSONResponse({
             'success': True,
             'mode': mode,
             'num_masks': len(encoded_masks),
@@ -284,6 +553,13 @@ if __name__ == "__main__":
         "main:app",
         host="0.0.0.0",
         port=8000,
-        reload=True,
+        # uvloop event loop + httptools parser for faster request handling
+        loop="uvloop",
+        http="httptools",
+        # One worker: the GPU is the bottleneck and requests are batched in-process
+        workers=1,
+        timeout_keep_alive=30,
+        # Auto-reload is for development only
+        reload=os.getenv("SAM2_RELOAD", "0") == "1",
         log_level="info"
     ) 
\ No newline at end of file
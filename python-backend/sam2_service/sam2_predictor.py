@@ -5,33 +5,65 @@ Handles model loading, inference, and different segmentation modes
 """
 
 import os
+import hashlib
+import contextlib
 import logging
+import threading
 from typing import List, Dict, Any, Optional, Tuple
 import asyncio
+from collections import OrderedDict
 from pathlib import Path
 
 import numpy as np
 import torch
 from PIL import Image
-import requests
+import httpx
 from tqdm import tqdm
 
 logger = logging.getLogger(__name__)
 
+# Parallel connections used to download model checkpoints
+DOWNLOAD_CONNECTIONS = 8
+
+# Default automatic mask generator settings (tuned for interactive use)
+DEFAULT_POINTS_PER_SIDE = 16
+DEFAULT_POINTS_PER_BATCH = 256
+DEFAULT_CROP_N_LAYERS = 0
+
+# Number of differently-configured automatic mask generators to keep around
+MASK_GENERATOR_CACHE_SIZE = 4
+
 class SAM2Predictor:
     """SAM 2 Predictor for image segmentation"""
     
-    def __init__(self, model_size: str = "large"):
+    def __init__(self, model_size: str = "large", embed_cache_size: int = 8):
         """
         Initialize SAM 2 Predictor
         
         Args:
             model_size: Model size ('tiny', 'small', 'base_plus', 'large')
+            embed_cache_size: Number of image embeddings to keep for re-prompting
         """
         self.model_size = model_size
         self.device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
         self.model = None
         self.predictor = None
+        self.mask_generator = None
+        self.mask_generator_lock = threading.Lock()
+        self._cpu_to_tensor = None
+        
+        # Autocast dtype on CUDA; chosen in load_model from native bf16 support
+        self.autocast_dtype = torch.bfloat16
+        
+        # LRU cache of image embeddings, keyed by image content hash
+        self.embed_cache_size = embed_cache_size
+        self._embed_cache: "OrderedDict[bytes, Tuple[Any, Any]]" = OrderedDict()
+        
+        # Automatic mask generators, keyed by (points_per_side, points_per_batch, crop_n_layers).
+        # Each generator wraps its own stateful SAM2ImagePredictor, so it is paired with a
+        # lock that serializes generate() calls across executor threads.
+        self._mask_generators: "OrderedDict[Tuple[int, int, int], Tuple[Any, threading.Lock]]" = OrderedDict()
+        self._mask_generators_lock = threading.Lock()
         
         # Model configurations
         self.model_configs = {
@@ -74,23 +106,102 @@ class SAM2Predictor:
         
         logger.info(f"Downloading {filename} from {url}")
         
-        def _download():
-            response = requests.get(url, stream=True)
+        # Download to a temporary file so an interrupted download is never mistaken for a model
+        part_path = model_path.with_name(filename + ".part")
+        
+        try:
+            async with httpx.AsyncClient(follow_redirects=True, timeout=60) as client:
+                try:
+                    head = await client.head(url)
+                    head.raise_for_status()
+                    total_size = int(head.headers.get('content-length', 0))
+                    accepts_ranges = head.headers.get('accept-ranges', '').lower() == 'bytes'
+                except httpx.HTTPStatusError:
+                    # Some servers reject HEAD; a plain streamed GET still works
+                    total_size = 0
+                    accepts_ranges = False
+                
+                if total_size and accepts_ranges and hasattr(os, 'pwrite'):
+                    await self._download_ranges(client, url, part_path, total_size, filename)
+                else:
+                    await self._download_stream(client, url, part_path, filename)
+            
+            os.replace(part_path, model_path)
+        except Exception:
+            if part_path.exists():
+                part_path.unlink()
+            raise
+        
+        return model_path
+    
+    async def _download_ranges(
+        self,
+        client: httpx.AsyncClient,
+        url: str,
+        path: Path,
+        total_size: int,
+        filename: str
+    ):
+        """Download a file as parallel HTTP range requests written in place"""
+        chunk_size = -(-total_size // DOWNLOAD_CONNECTIONS)
+        fd = os.open(path, os.O_RDWR | os.O_CREAT | os.O_TRUNC, 0o644)
+        
+        try:
+            # Preallocate so every range can be written at its final offset
+            try:
+                os.posix_fallocate(fd, 0, total_size)
+            except (AttributeError, OSError):
+                # Not available on this platform/filesystem; a sparse file works too
+                os.ftruncate(fd, total_size)
+            
+            with tqdm(total=total_size, unit='B', unit_scale=True, desc=filename) as pbar:
+                async def _fetch(start: int, end: int):
+                    offset = start
+                    headers = {'Range': f'bytes={start}-{end}'}
+                    async with client.stream('GET', url, headers=headers) as response:
+                        if response.status_code != 206:
+                            raise RuntimeError(f"Range request not honoured (HTTP {response.status_code})")
+                        async for chunk in response.aiter_bytes(1 << 20):
+                            os.pwrite(fd, chunk, offset)
+                            offset += len(chunk)
+                            pbar.update(len(chunk))
+                    
+                    if offset != end + 1:
+                        raise RuntimeError(f"Incomplete download of bytes {start}-{end}")
+                
+                tasks = [
+                    asyncio.ensure_future(_fetch(start, min(start + chunk_size, total_size) - 1))
+                    for start in range(0, total_size, chunk_size)
+                ]
+                try:
+                    await asyncio.gather(*tasks)
+                except BaseException:
+                    # Stop the remaining ranges before fd is closed below
+                    for task in tasks:
+                        task.cancel()
+                    await asyncio.gather(*tasks, return_exceptions=True)
+                    raise
+        finally:
+            os.close(fd)
+    
+    async def _download_stream(
+        self,
+        client: httpx.AsyncClient,
+        url: str,
+        path: Path,
+        filename: str
+    ):
+        """Download a file over a single streamed connection"""
+        async with client.stream('GET', url) as response:
             response.raise_for_status()
             
             total_size = int(response.headers.get('content-length', 0))
             
-            with open(model_path, 'wb') as f:
+            with open(path, 'wb') as f:
                 with tqdm(total=total_size, unit='B', unit_scale=True, desc=filename) as pbar:
-                    for chunk in response.iter_content(chunk_size=8192):
-                        if chunk:
-                            f.write(chunk)
-                            pbar.update(len(chunk))
-            
-            return model_path
-        
-        loop = asyncio.get_event_loop()
-        return await loop.run_in_executor(None, _download)
+                    async for chunk in response.aiter_bytes(1 << 20):
+                        f.write(chunk)
+                        pbar.update(len(chunk))
     
     async def load_model(self):
         """Load SAM 2 model"""
@@ -119,49 +230,302 @@ class SAM2Predictor:
             logger.info("Building SAM 2 model...")
             self.model = build_sam2(
                 config_file=config["config"],
-                ckpt_path=str(checkpoint_path),
+                ckpt_path=None,
                 device=self.device
             )
+            self._load_checkpoint(checkpoint_path)
             
             # Create predictor
             self.predictor = SAM2ImagePredictor(self.model)
             
+            # Build the default automatic mask generator once
+            self.mask_generator, self.mask_generator_lock = self._get_mask_generator(
+                DEFAULT_POINTS_PER_SIDE, DEFAULT_POINTS_PER_BATCH, DEFAULT_CROP_N_LAYERS
+            )
+            
+            if self.device.type == "cuda":
+                # Pick the reduced-precision dtype this GPU runs natively
+                self.autocast_dtype = self._select_autocast_dtype()
+                logger.info(f"Using {self.autocast_dtype} autocast on {self.device}")
+                
+                # Let Ampere+ GPUs use TF32 tensor cores and autotune conv kernels
+                torch.backends.cuda.matmul.allow_tf32 = True
+                torch.backends.cudnn.allow_tf32 = True
+                torch.backends.cudnn.benchmark = True
+                
+                # Upload images as uint8 via pinned memory; resize/normalize on the GPU
+                self._cpu_to_tensor = self.predictor._transforms.to_tensor
+                self.predictor._transforms.to_tensor = self._image_to_device
+                
+                self._compile_model()
+            
             logger.info(f"SAM 2 {self.model_size} model loaded successfully!")
             
         except Exception as e:
             logger.error(f"Failed to load SAM 2 model: {e}")
             raise
     
-    def segment_everything(self, image: np.ndarray) -> Dict[str, Any]:
+    def _image_to_device(self, image: Any) -> torch.Tensor:
         """
-        Segment everything in the image
+        Replacement for SAM2Transforms.to_tensor: copies the uint8 image to the
+        device from pinned memory without blocking, then converts it to a
+        CHW float tensor in [0, 1] on the device
+        """
+        if not (isinstance(image, np.ndarray) and image.dtype == np.uint8 and image.ndim == 3):
+            return self._cpu_to_tensor(image).to(self.device)
         
-        Args:
-            image: Input image as numpy array (H, W, 3)
-            
-        Returns:
-            Dictionary with masks and scores
+        tensor = torch.from_numpy(np.ascontiguousarray(image)).pin_memory()
+        tensor = tensor.to(self.device, non_blocking=True)
+        return tensor.permute(2, 0, 1).float().div_(255)
+    
+    def _load_checkpoint(self, checkpoint_path: Path):
         """
-        if not self.predictor:
-            raise RuntimeError("Model not loaded")
+        Load checkpoint weights into the built model, memory-mapping the file
+        so tensors are paged in on demand instead of read into RAM up front
+        """
+        try:
+            checkpoint = torch.load(
+                str(checkpoint_path), map_location="cpu", weights_only=True, mmap=True
+            )
+        except TypeError:
+            # torch < 2.1 has no mmap support; still never unpickle arbitrary objects
+            checkpoint = torch.load(str(checkpoint_path), map_location="cpu", weights_only=True)
+        
+        missing_keys, unexpected_keys = self.model.load_state_dict(checkpoint["model"])
+        if missing_keys or unexpected_keys:
+            raise RuntimeError(
+                f"Checkpoint mismatch (missing: {missing_keys}, unexpected: {unexpected_keys})"
+            )
+        
+        del checkpoint
+    
+    def _compile_model(self):
+        """
+        Compile the prompt encoder and mask decoder with torch.compile and
+        warm them up, falling back to eager mode if compilation fails
+        
+        CUDA graphs are not used: inference runs on executor threads (not the
+        thread doing this warm-up), and prompt/batch shapes vary per request,
+        which cudagraph trees handle poorly. Shapes are compiled as dynamic so
+        new prompt counts do not trigger a recompile each time.
+        """
+        mask_decoder = self.model.sam_mask_decoder
+        prompt_encoder = self.model.sam_prompt_encoder
+        
+        # Fall back to eager for any graph that fails to (re)compile at request time
+        torch._dynamo.config.suppress_errors = True
         
         try:
+            logger.info("Compiling SAM 2 mask decoder...")
+            self.model.sam_mask_decoder = torch.compile(
+                mask_decoder, dynamic=True, fullgraph=False
+            )
+            self.model.sam_prompt_encoder = torch.compile(
+                prompt_encoder, dynamic=True
+            )
+            
+            # Pay the compile cost now rather than on the first request
+            dummy_image = np.zeros((1024, 1024, 3), dtype=np.uint8)
+            with self._inference_context():
+                self.predictor.set_image(dummy_image)
+                self.predictor.predict(
+                    point_coords=np.array([[512, 512]], dtype=np.float32),
+                    point_labels=np.ones(1, dtype=np.int32),
+                    multimask_output=True,
+                )
+            self.predictor.reset_predictor()
+            
+            logger.info("SAM 2 mask decoder compiled")
+        except Exception as e:
+            logger.warning(f"torch.compile failed, using eager mode: {e}")
+            self.model.sam_mask_decoder = mask_decoder
+            self.model.sam_prompt_encoder = prompt_encoder
+            self.predictor.reset_predictor()
+    
+    def _select_autocast_dtype(self) -> torch.dtype:
+        """
+        Use bfloat16 only where the GPU supports it natively (Ampere+);
+        pre-Ampere GPUs (T4, V100) emulate it, so fall back to float16 there
+        """
+        try:
+            native_bf16 = torch.cuda.is_bf16_supported(including_emulation=False)
+        except TypeError:
+            # Older torch has no including_emulation flag; check the architecture directly
+            native_bf16 = torch.cuda.get_device_capability(self.device)[0] >= 8
+        
+        return torch.bfloat16 if native_bf16 else torch.float16
+    
+    def _inference_context(self) -> contextlib.ExitStack:
+        """Inference mode with bf16/fp16 autocast on CUDA (fp32 elsewhere)"""
+        stack = contextlib.ExitStack()
+        stack.enter_context(torch.inference_mode())
+        stack.enter_context(torch.autocast(
+            device_type=self.device.type,
+            dtype=self.autocast_dtype,
+            enabled=self.device.type == "cuda"
+        ))
+        return stack
+    
+    def _set_image(self, image: np.ndarray):
+        """
+        Set the predictor image, reusing a cached embedding when the same
+        image has been prompted recently
+        """
+        key = self._image_key(image)
+        
+        cached = self._embed_cache.get(key)
+        if cached is not None:
+            # Restore the state SAM2ImagePredictor keeps after set_image
+            self._embed_cache.move_to_end(key)
+            self.predictor.reset_predictor()
+            self.predictor._features, self.predictor._orig_hw = cached
+            self.predictor._is_image_set = True
+            self.predictor._is_batch = False
+            return
+        
+        self.predictor.set_image(image)
+        self._store_embedding(key, (self.predictor._features, self.predictor._orig_hw))
+    
+    def _set_image_batch(self, images: List[np.ndarray]):
+        """
+        Set a batch of predictor images, encoding only those that are neither
+        cached nor repeated within the batch, and caching the new embeddings
+        """
+        keys = [self._image_key(image) for image in images]
+        
+        # Collect one embedding per distinct image: cache hits first, then encode the rest
+        embeddings: Dict[bytes, Tuple[Any, Any]] = {}
+        to_encode: Dict[bytes, np.ndarray] = {}
+        for key, image in zip(keys, images):
+            if key in embeddings or key in to_encode:
+                continue
+            cached = self._embed_cache.get(key)
+            if cached is not None:
+                self._embed_cache.move_to_end(key)
+                embeddings[key] = cached
+            else:
+                to_encode[key] = image
+        
+        if to_encode:
+            self.predictor.set_image_batch(list(to_encode.values()))
+            features = self.predictor._features
+            
+            # Split the batched features into single-image entries (the set_image layout)
+            for i, key in enumerate(to_encode):
+                embeddings[key] = (
+                    {
+                        "image_embed": features["image_embed"][i:i + 1].clone(),
+                        "high_res_feats": [
+                            feat[i:i + 1].clone() for feat in features["high_res_feats"]
+                        ],
+                    },
+                    [self.predictor._orig_hw[i]],
+                )
+                self._store_embedding(key, embeddings[key])
+        
+        # Reassemble the batched state SAM2ImagePredictor keeps after set_image_batch
+        self.predictor.reset_predictor()
+        self.predictor._features = {
+            "image_embed": torch.cat([embeddings[key][0]["image_embed"] for key in keys]),
+            "high_res_feats": [
+                torch.cat(level)
+                for level in zip(*(embeddings[key][0]["high_res_feats"] for key in keys))
+            ],
+        }
+        self.predictor._orig_hw = [embeddings[key][1][0] for key in keys]
+        self.predictor._is_image_set = True
+        self.predictor._is_batch = True
+    
+    def _image_key(self, image: np.ndarray) -> bytes:
+        """Hash image content and shape to key the embedding cache"""
+        image = np.ascontiguousarray(image)
+        hasher = hashlib.blake2b(image.data, digest_size=16)
+        hasher.update(str(image.shape).encode())
+        return hasher.digest()
+    
+    def _store_embedding(self, key: bytes, embedding: Tuple[Any, Any]):
+        """Insert an embedding into the LRU cache, evicting the oldest if full"""
+        self._embed_cache[key] = embedding
+        self._embed_cache.move_to_end(key)
+        if len(self._embed_cache) > self.embed_cache_size:
+            self._embed_cache.popitem(last=False)
+    
+    def _get_mask_generator(
+        self,
+        points_per_side: int,
+        points_per_batch: int,
+        crop_n_layers: int
+    ) -> Tuple[Any, threading.Lock]:
+        """
+        Return a mask generator for these settings, reusing recent ones,
+        together with the lock that must be held while calling generate()
+        """
+        key = (points_per_side, points_per_batch, crop_n_layers)
+        
+        # The default generator is built at load time and never evicted
+        if self.mask_generator is not None and key == (
+            DEFAULT_POINTS_PER_SIDE, DEFAULT_POINTS_PER_BATCH, DEFAULT_CROP_N_LAYERS
+        ):
+            return self.mask_generator, self.mask_generator_lock
+        
+        with self._mask_generators_lock:
+            entry = self._mask_generators.get(key)
+            if entry is not None:
+                self._mask_generators.move_to_end(key)
+                return entry
+            
             # Import automatic mask generator
             from sam2.automatic_mask_generator import SAM2AutomaticMaskGenerator
             
             # Create mask generator
             mask_generator = SAM2AutomaticMaskGenerator(
                 model=self.model,
-                points_per_side=32,
+                points_per_side=points_per_side,
+                points_per_batch=points_per_batch,
                 pred_iou_thresh=0.7,
                 stability_score_thresh=0.92,
-                crop_n_layers=1,
+                crop_n_layers=crop_n_layers,
                 crop_n_points_downscale_factor=2,
                 min_mask_region_area=100,
             )
             
-            # Generate masks
-            masks = mask_generator.generate(image)
+            entry = (mask_generator, threading.Lock())
+            self._mask_generators[key] = entry
+            if len(self._mask_generators) > MASK_GENERATOR_CACHE_SIZE:
+                self._mask_generators.popitem(last=False)
+            
+            return entry
+    
+    def segment_everything(
+        self,
+        image: np.ndarray,
+        points_per_side: int = DEFAULT_POINTS_PER_SIDE,
+        points_per_batch: int = DEFAULT_POINTS_PER_BATCH,
+        crop_n_layers: int = DEFAULT_CROP_N_LAYERS
+    ) -> Dict[str, Any]:
+        """
+        Segment everything in the image
+        
+        Args:
+            image: Input image as numpy array (H, W, 3)
+            points_per_side: Grid size of point prompts (prompts grow quadratically)
+            points_per_batch: Number of point prompts run through the decoder at once
+            crop_n_layers: Number of extra crop layers (each adds more prompts)
+            
+        Returns:
+            Dictionary with masks and scores
+        """
+        if not self.predictor:
+            raise RuntimeError("Model not loaded")
+        
+        try:
+            mask_generator, generator_lock = self._get_mask_generator(
+                points_per_side, points_per_batch, crop_n_layers
+            )
+            
+            # Generate masks (one request at a time per generator)
+            with generator_lock, self._inference_context():
+                masks = mask_generator.generate(image)
             
             # Extract masks and scores
             result_masks = []
@@ -189,29 +553,30 @@ class SAM2Predictor:
             points: List of [x, y] coordinates
             
         Returns:
-            Dictionary with masks and scores
+            Dictionary with masks (N, H, W) bool array and scores (N,) array
         """
         if not self.predictor:
             raise RuntimeError("Model not loaded")
         
         try:
-            # Set image
-            self.predictor.set_image(image)
-            
-            # Convert points to numpy array
-            input_points = np.array(points)
-            input_labels = np.ones(len(points))  # All positive points
-            
-            # Predict masks
-            masks, scores, logits = self.predictor.predict(
-                point_coords=input_points,
-                point_labels=input_labels,
-                multimask_output=True,
-            )
+            with self._inference_context():
+                # Set image
+                self._set_image(image)
+                
+                # Convert points to numpy array
+                input_points = np.asarray(points, dtype=np.float32)
+                input_labels = np.ones(len(points), dtype=np.int32)  # All positive points
+                
+                # Predict masks
+                masks, scores, logits = self.predictor.predict(
+                    point_coords=input_points,
+                    point_labels=input_labels,
+                    multimask_output=True,
+                )
             
             return {
-                'masks': masks.tolist(),
-                'scores': scores.tolist()
+                'masks': masks.astype(np.bool_, copy=False),
+                'scores': scores
             }
             
         except Exception as e:
@@ -227,42 +592,107 @@ class SAM2Predictor:
             boxes: List of [x1, y1, x2, y2] coordinates
             
         Returns:
-            Dictionary with masks and scores
+            Dictionary with masks (N, H, W) bool array and scores (N,) array
         """
         if not self.predictor:
             raise RuntimeError("Model not loaded")
         
         try:
-            # Set image
-            self.predictor.set_image(image)
-            
-            all_masks = []
-            all_scores = []
-            
-            # Process each box
-            for box in boxes:
-                input_box = np.array(box)
+            with self._inference_context():
+                # Set image
+                self._set_image(image)
+                
+                # Batch all boxes through the mask decoder in a single call
+                input_boxes = np.asarray(boxes, dtype=np.float32).reshape(-1, 4)
                 
                 # Predict masks
                 masks, scores, logits = self.predictor.predict(
-                    box=input_box,
+                    box=input_boxes,
                     multimask_output=False,
                 )
-                
-                all_masks.extend(masks.tolist())
-                all_scores.extend(scores.tolist())
+            
+            # Multiple boxes come back as (N, 1, H, W); a single box as (1, H, W)
+            if masks.ndim == 4:
+                masks = masks[:, 0]
+                scores = scores[:, 0]
             
             return {
-                'masks': all_masks,
-                'scores': all_scores
+                'masks': masks.astype(np.bool_, copy=False),
+                'scores': scores
             }
             
         except Exception as e:
             logger.error(f"Error in segment_with_boxes: {e}")
             raise
     
+    def segment_batch(
+        self,
+        images: List[np.ndarray],
+        mode: str,
+        prompts: List[List[List[int]]]
+    ) -> List[Dict[str, Any]]:
+        """
+        Segment several images with prompts in a single batched forward pass
+        
+        Args:
+            images: List of input images as numpy arrays (H, W, 3)
+            mode: Prompt type shared by the whole batch ('points' or 'boxes')
+            prompts: Per-image list of [x, y] points or [x1, y1, x2, y2] boxes
+            
+        Returns:
+            List of dictionaries with masks (N, H, W) bool array and scores
+            (N,) array, one per image
+        """
+        if not self.predictor:
+            raise RuntimeError("Model not loaded")
+        
+        try:
+            with self._inference_context():
+                # Encode the uncached images together
+                self._set_image_batch(images)
+                
+                if mode == "points":
+                    point_coords_batch = [np.asarray(p, dtype=np.float32) for p in prompts]
+                    point_labels_batch = [np.ones(len(p), dtype=np.int32) for p in prompts]
+                    
+                    masks_batch, scores_batch, logits_batch = self.predictor.predict_batch(
+                        point_coords_batch=point_coords_batch,
+                        point_labels_batch=point_labels_batch,
+                        multimask_output=True,
+                    )
+                elif mode == "boxes":
+                    box_batch = [np.asarray(b, dtype=np.float32).reshape(-1, 4) for b in prompts]
+                    
+                    masks_batch, scores_batch, logits_batch = self.predictor.predict_batch(
+                        box_batch=box_batch,
+                        multimask_output=False,
+                    )
+                else:
+                    raise ValueError(f"Invalid batch segmentation mode: {mode}")
+            
+            results = []
+            for masks, scores in zip(masks_batch, scores_batch):
+                # Multiple boxes come back as (N, 1, H, W); a single box as (1, H, W)
+                if mode == "boxes" and masks.ndim == 4:
+                    masks = masks[:, 0]
+                    scores = scores[:, 0]
+                
+                results.append({
+                    'masks': masks.astype(np.bool_, copy=False),
+                    'scores': scores
+                })
+            
+            return results
+            
+        except Exception as e:
+            logger.error(f"Error in segment_batch: {e}")
+            raise
+    
     def cleanup(self):
         """Cleanup resources"""
+        self._embed_cache.clear()
+        self._mask_generators.clear()
+        self.mask_generator = None
         if self.model:
             del self.model
         if self.predictor:
@@ -0,0 +1,9 @@
+"""
+Pytest configuration for the SAM 2 backend tests
+Makes the sam2_service modules importable the same way main.py imports them
+"""
+
+import sys
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / "sam2_service"))
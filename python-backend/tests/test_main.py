@@ -0,0 +1,221 @@
+"""
+Tests for the SAM 2 FastAPI service helpers and request batching
+"""
+
+import asyncio
+import base64
+import io
+
+import numpy as np
+import pytest
+from fastapi import HTTPException
+from PIL import Image
+
+import main
+
+IMAGE = np.zeros((8, 8, 3), dtype=np.uint8)
+
+
+def _random_mask(shape, seed=0):
+    return np.random.default_rng(seed).random(shape) > 0.5
+
+
+class FakePredictor:
+    """Stands in for SAM2Predictor, recording the calls the scheduler makes"""
+
+    def __init__(self, fail_batch=False, bad_prompt=None):
+        self.fail_batch = fail_batch
+        self.bad_prompt = bad_prompt
+        self.batch_calls = []
+        self.single_calls = []
+
+    def segment_batch(self, images, mode, prompts):
+        self.batch_calls.append((mode, prompts))
+        if self.fail_batch:
+            raise ValueError("bad prompt shape in batch")
+        return [{"mode": mode, "prompts": p} for p in prompts]
+
+    def _single(self, mode, prompts):
+        self.single_calls.append((mode, prompts))
+        if prompts == self.bad_prompt:
+            raise ValueError("bad prompt shape")
+        return {"mode": mode, "prompts": prompts}
+
+    def segment_with_points(self, image, points):
+        return self._single("points", points)
+
+    def segment_with_boxes(self, image, boxes):
+        return self._single("boxes", boxes)
+
+
+@pytest.fixture
+def fake_predictor(monkeypatch):
+    fake = FakePredictor()
+    monkeypatch.setattr(main, "predictor", fake)
+    return fake
+
+
+def _run_with_scheduler(coro_factory):
+    """Run coro_factory(scheduler) with a started scheduler on a fresh loop"""
+
+    async def _runner():
+        scheduler = main.BatchScheduler(max_batch=8, max_wait=0.05)
+        scheduler.start()
+        try:
+            return await coro_factory(scheduler)
+        finally:
+            await scheduler.stop()
+
+    return asyncio.run(_runner())
+
+
+def test_batch_scheduler_groups_requests_by_mode(fake_predictor):
+    points_a, points_b = [[1, 1]], [[2, 2], [3, 3]]
+    boxes_a, boxes_b = [[0, 0, 4, 4]], [[1, 1, 5, 5]]
+
+    results = _run_with_scheduler(
+        lambda scheduler: asyncio.gather(
+            scheduler.submit(IMAGE, "points", points=points_a),
+            scheduler.submit(IMAGE, "boxes", boxes=boxes_a),
+            scheduler.submit(IMAGE, "points", points=points_b),
+            scheduler.submit(IMAGE, "boxes", boxes=boxes_b),
+        )
+    )
+
+    assert fake_predictor.batch_calls == [
+        ("points", [points_a, points_b]),
+        ("boxes", [boxes_a, boxes_b]),
+    ]
+    assert fake_predictor.single_calls == []
+    assert [r["prompts"] for r in results] == [points_a, boxes_a, points_b, boxes_b]
+
+
+def test_batch_scheduler_isolates_failures_to_the_bad_request(fake_predictor):
+    good, bad = [[1, 1]], [[1, 2, 3]]
+    fake_predictor.fail_batch = True
+    fake_predictor.bad_prompt = bad
+
+    results = _run_with_scheduler(
+        lambda scheduler: asyncio.gather(
+            scheduler.submit(IMAGE, "points", points=good),
+            scheduler.submit(IMAGE, "points", points=bad),
+            return_exceptions=True,
+        )
+    )
+
+    assert len(fake_predictor.batch_calls) == 1
+    assert results[0] == {"mode": "points", "prompts": good}
+    assert isinstance(results[1], ValueError)
+
+
+def test_batch_scheduler_skips_cancelled_requests(fake_predictor):
+    cancelled, live = [[1, 1]], [[2, 2]]
+
+    async def _scenario(scheduler):
+        task = asyncio.create_task(scheduler.submit(IMAGE, "points", points=cancelled))
+        await asyncio.sleep(0)
+        task.cancel()
+        return await scheduler.submit(IMAGE, "points", points=live)
+
+    result = _run_with_scheduler(_scenario)
+
+    assert result == {"mode": "points", "prompts": live}
+    assert fake_predictor.batch_calls == []
+    assert fake_predictor.single_calls == [("points", live)]
+
+
+def _decode_png(mask_base64):
+    image = Image.open(io.BytesIO(base64.b64decode(mask_base64)))
+    return image, np.array(image).astype(bool)
+
+
+def test_encode_mask_to_base64_round_trips_as_1bit_png():
+    mask = _random_mask((37, 53))
+
+    image, decoded = _decode_png(main.encode_mask_to_base64(mask))
+
+    assert image.mode == "1"
+    assert np.array_equal(decoded, mask)
+
+
+def test_encode_mask_to_base64_accepts_float_masks():
+    mask = _random_mask((16, 16))
+
+    _, decoded = _decode_png(main.encode_mask_to_base64(mask.astype(np.float32)))
+
+    assert np.array_equal(decoded, mask)
+
+
+def test_encode_mask_to_base64_reuses_buffer_after_larger_mask():
+    large = _random_mask((512, 512), seed=1)
+    small = _random_mask((9, 11), seed=2)
+
+    main.encode_mask_to_base64(large)
+    _, decoded = _decode_png(main.encode_mask_to_base64(small))
+
+    assert np.array_equal(decoded, small)
+
+
+def test_encode_mask_packed_round_trips():
+    mask = _random_mask((13, 7))
+
+    encoded = main.encode_mask_packed(mask)
+    packed = np.frombuffer(base64.b64decode(encoded["data"]), dtype=np.uint8)
+    bits = np.unpackbits(packed)
+    h, w = encoded["shape"]
+
+    assert [h, w] == [13, 7]
+    assert np.array_equal(bits[: h * w].reshape(h, w).astype(bool), mask)
+
+
+def test_encode_mask_rle_round_trips():
+    mask_util = pytest.importorskip("pycocotools.mask")
+    mask = _random_mask((20, 30))
+
+    encoded = main.encode_mask_rle(mask)
+    decoded = mask_util.decode(
+        {"size": encoded["size"], "counts": encoded["counts"].encode("ascii")}
+    )
+
+    assert encoded["size"] == [20, 30]
+    assert np.array_equal(decoded.astype(bool), mask)
+
+
+def test_compute_mask_areas_on_array_and_list():
+    masks = np.stack([_random_mask((10, 10), seed=i) for i in range(3)])
+    expected = [int(m.sum()) for m in masks]
+
+    assert main.compute_mask_areas(masks) == expected
+    assert main.compute_mask_areas(list(masks)) == expected
+    assert main.compute_mask_areas([]) == []
+
+
+@pytest.mark.parametrize(
+    "points_per_side, points_per_batch, crop_n_layers",
+    [(1, 1, 0), (16, 256, 0), (64, 256, 2)],
+)
+def test_parse_everything_options_accepts_values_in_range(
+    points_per_side, points_per_batch, crop_n_layers
+):
+    options = main.parse_everything_options(
+        points_per_side, points_per_batch, crop_n_layers
+    )
+
+    assert options == {
+        "points_per_side": points_per_side,
+        "points_per_batch": points_per_batch,
+        "crop_n_layers": crop_n_layers,
+    }
+
+
+@pytest.mark.parametrize(
+    "points_per_side, points_per_batch, crop_n_layers",
+    [(0, 256, 0), (65, 256, 0), (16, 0, 0), (16, 257, 0), (16, 256, -1), (16, 256, 3)],
+)
+def test_parse_everything_options_rejects_out_of_range_values(
+    points_per_side, points_per_batch, crop_n_layers
+):
+    with pytest.raises(HTTPException) as exc_info:
+        main.parse_everything_options(points_per_side, points_per_batch, crop_n_layers)
+
+    assert exc_info.value.status_code == 400
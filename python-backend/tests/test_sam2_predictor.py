@@ -0,0 +1,168 @@
+"""
+Tests for SAM2Predictor checkpoint downloads
+"""
+
+import asyncio
+
+import httpx
+import numpy as np
+import pytest
+import torch
+
+import sam2_predictor
+from sam2_predictor import SAM2Predictor
+
+URL = "https://example.com/checkpoint.pt"
+FILENAME = "checkpoint.pt"
+PAYLOAD = bytes(range(256)) * 40 + b"tail"
+
+
+def _range_handler(fail_start=None, head_status=200, accept_ranges=True):
+    """Serve PAYLOAD with HEAD + Range support; the range at fail_start errors"""
+
+    def handler(request):
+        if request.method == "HEAD":
+            if head_status != 200:
+                return httpx.Response(head_status)
+            headers = {"content-length": str(len(PAYLOAD))}
+            if accept_ranges:
+                headers["accept-ranges"] = "bytes"
+            return httpx.Response(200, headers=headers)
+
+        range_header = request.headers.get("range")
+        if range_header is None:
+            return httpx.Response(200, content=PAYLOAD)
+
+        start, end = (int(v) for v in range_header[len("bytes="):].split("-"))
+        if start == fail_start:
+            return httpx.Response(500)
+        return httpx.Response(206, content=PAYLOAD[start:end + 1])
+
+    return handler
+
+
+@pytest.fixture
+def predictor(tmp_path):
+    predictor = SAM2Predictor(model_size="tiny")
+    predictor.models_dir = tmp_path
+    return predictor
+
+
+@pytest.fixture
+def mock_http(monkeypatch):
+    """Route httpx.AsyncClient inside sam2_predictor through a MockTransport"""
+    requests_seen = []
+    real_client = httpx.AsyncClient
+
+    def install(handler):
+        def recording_handler(request):
+            requests_seen.append(request)
+            return handler(request)
+
+        transport = httpx.MockTransport(recording_handler)
+        monkeypatch.setattr(
+            sam2_predictor.httpx,
+            "AsyncClient",
+            lambda **kwargs: real_client(transport=transport, **kwargs),
+        )
+        return requests_seen
+
+    return install
+
+
+def test_download_model_fetches_parallel_ranges(predictor, mock_http):
+    requests_seen = mock_http(_range_handler())
+
+    path = asyncio.run(predictor.download_model(URL, FILENAME))
+
+    assert path.read_bytes() == PAYLOAD
+    assert not (predictor.models_dir / (FILENAME + ".part")).exists()
+    ranges = [r.headers["range"] for r in requests_seen if r.method == "GET"]
+    assert len(ranges) == sam2_predictor.DOWNLOAD_CONNECTIONS
+
+
+def test_download_model_failed_range_removes_partial_file(predictor, mock_http):
+    chunk_size = -(-len(PAYLOAD) // sam2_predictor.DOWNLOAD_CONNECTIONS)
+    mock_http(_range_handler(fail_start=3 * chunk_size))
+
+    with pytest.raises(RuntimeError, match="Range request not honoured"):
+        asyncio.run(predictor.download_model(URL, FILENAME))
+
+    assert not (predictor.models_dir / FILENAME).exists()
+    assert not (predictor.models_dir / (FILENAME + ".part")).exists()
+
+
+def test_download_model_detects_short_range(predictor, mock_http):
+    def short_handler(request):
+        response = _range_handler()(request)
+        if response.status_code == 206:
+            return httpx.Response(206, content=response.content[:-1])
+        return response
+
+    mock_http(short_handler)
+
+    with pytest.raises(RuntimeError, match="Incomplete download"):
+        asyncio.run(predictor.download_model(URL, FILENAME))
+
+    assert not (predictor.models_dir / FILENAME).exists()
+
+
+@pytest.mark.parametrize(
+    "handler_kwargs", [{"head_status": 405}, {"accept_ranges": False}]
+)
+def test_download_model_falls_back_to_single_stream(
+    predictor, mock_http, handler_kwargs
+):
+    requests_seen = mock_http(_range_handler(**handler_kwargs))
+
+    path = asyncio.run(predictor.download_model(URL, FILENAME))
+
+    assert path.read_bytes() == PAYLOAD
+    gets = [r for r in requests_seen if r.method == "GET"]
+    assert len(gets) == 1 and "range" not in gets[0].headers
+
+
+class FakeImagePredictor:
+    """Mimics the SAM2ImagePredictor state written by set_image_batch"""
+
+    def __init__(self):
+        self.encoded = []
+
+    def reset_predictor(self):
+        self._features = None
+        self._orig_hw = None
+        self._is_image_set = False
+        self._is_batch = False
+
+    def set_image_batch(self, images):
+        self.encoded.append([int(image[0, 0, 0]) for image in images])
+        ids = torch.tensor([float(image[0, 0, 0]) for image in images])
+        self._features = {
+            "image_embed": ids.view(-1, 1, 1, 1).expand(-1, 2, 2, 2).clone(),
+            "high_res_feats": [ids.view(-1, 1, 1, 1).expand(-1, 1, 4, 4).clone()],
+        }
+        self._orig_hw = [image.shape[:2] for image in images]
+        self._is_image_set = True
+        self._is_batch = True
+
+
+def _image(value):
+    return np.full((4, 6, 3), value, dtype=np.uint8)
+
+
+def test_set_image_batch_reuses_cache_and_dedupes(predictor):
+    predictor.predictor = FakeImagePredictor()
+
+    predictor._set_image_batch([_image(1), _image(2), _image(1)])
+    predictor._set_image_batch([_image(2), _image(3)])
+
+    # Image 1 is encoded once despite repeating; image 2 comes from the cache later
+    assert predictor.predictor.encoded == [[1, 2], [3]]
+
+    features = predictor.predictor._features
+    assert features["image_embed"].shape == (2, 2, 2, 2)
+    assert features["image_embed"][:, 0, 0, 0].tolist() == [2.0, 3.0]
+    assert features["high_res_feats"][0][:, 0, 0, 0].tolist() == [2.0, 3.0]
+    assert predictor.predictor._orig_hw == [(4, 6), (4, 6)]
+    assert predictor.predictor._is_batch
+    assert len(predictor._embed_cache) == 3